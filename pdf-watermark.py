@@ -1,7 +1,14 @@
+# Note on concurrency: pages are stamped serially on purpose. PyMuPDF does
+# not release the GIL and MuPDF does not support concurrent writes to one
+# Document, so a thread pool over `insert_image` would at best serialize and
+# at worst corrupt the output. Sharing a single image xref across pages
+# already makes each per-page insertion cheap.
 import fitz  # PyMuPDF
-from PIL import Image, ImageEnhance, ImageFilter, ImageDraw, ImageFont
+import numpy as np
+from PIL import Image
 import io
 import argparse
+import functools
 import os
 
 
@@ -10,66 +17,89 @@ def hex_to_rgb(hex_color: str):
     hex_color = hex_color.lstrip("#")
     if len(hex_color) != 6:
         raise ValueError("Invalid HEX color. Use format #RRGGBB.")
-    return tuple(int(hex_color[i : i + 2], 16) for i in (0, 2, 4))
-
-
-def create_text_image(
-    text: str,
-    max_width: float,
-    max_height: float,
-    font_path: str,
-    font_size: int,
-    text_color: tuple,
-    text_opacity: float,
-    shadow: bool,
-    shadow_opacity: float,
-    shadow_offset: int = 5,
-):
+    try:
+        r, g, b = bytes.fromhex(hex_color)
+    except ValueError:
+        raise ValueError("Invalid HEX color. Use format #RRGGBB.") from None
+    return r, g, b
+
+
+# Base14 Helvetica-Bold: needs no embedding, but insert_text can only draw
+# Latin-1 characters with it
+BASE14_FONT = "hebo"
+DEFAULT_FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts", "dejavu-sans.bold.ttf")
+
+
+def _resolve_font(font_path: str, text: str):
     """
-    Render `text` onto a transparent PIL image of size (max_width, max_height),
-    center it, apply optional shadow, and return the RGBA image.
+    Pick the (fontname, fontfile) pair used to write `text`. A user-supplied
+    font is embedded; otherwise the Base14 font is used when it can represent
+    the text, falling back to the bundled TrueType font. Raises
+    FileNotFoundError if that font is needed but missing.
     """
-    # Create blank transparent image
-    canvas = Image.new("RGBA", (int(max_width), int(max_height)), (255, 255, 255, 0))
-    draw = ImageDraw.Draw(canvas)
-
     if font_path:
         if not os.path.isfile(font_path):
             raise FileNotFoundError(f"Font file not found: {font_path}")
-        font = ImageFont.truetype(font_path, font_size)
-    else:
-        # Try a built-in TrueType font so size actually works
-        try:
-            font = ImageFont.truetype("./fonts/dejavu-sans.bold.ttf", font_size)
-        except IOError:
-            # Fallback to the default bitmap font if TTF not found
-            font = ImageFont.load_default()
+        return "wmfont", font_path
+
+    try:
+        text.encode("latin-1")
+        return BASE14_FONT, None
+    except UnicodeEncodeError:
+        if not os.path.isfile(DEFAULT_FONT_PATH):
+            raise FileNotFoundError(
+                f"Font file not found: {DEFAULT_FONT_PATH} (needed for non-Latin-1 text; pass --font_path)"
+            ) from None
+        return "wmfont", DEFAULT_FONT_PATH
 
-    # Measure text size
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_w = bbox[2] - bbox[0]
-    text_h = bbox[3] - bbox[1]
 
-    # Center coordinates
-    x = (max_width - text_w) / 2
-    y = (max_height - text_h) / 2
+@functools.lru_cache(maxsize=32)
+def _load_font(fontname: str, fontfile: str):
+    """Load and cache the PyMuPDF font used to measure the watermark text."""
+    if fontfile:
+        return fitz.Font(fontfile=fontfile)
+    return fitz.Font(fontname)
+
+
+def _alpha_scale(opacity: float):
+    """Return `opacity` as the 8-bit fixed-point factor used to scale alpha (x * scale >> 8)."""
+    return int(opacity * 256)
+
+
+def _shadow_visible(shadow_opacity: float):
+    """Whether a shadow at `shadow_opacity` leaves any alpha on an opaque pixel."""
+    # 255 * scale >> 8 is zero for scale 0 and 1
+    return _alpha_scale(shadow_opacity) >= 2
+
+
+def add_image_shadow(img: Image.Image, shadow_opacity: float, shadow_offset: int = 5):
+    """
+    Return a copy of the RGBA image `img` with a black drop-shadow built from
+    its own alpha channel, offset by `shadow_offset` pixels down and right.
+    """
+    src = np.asarray(img)
+    h, w = src.shape[:2]
+    canvas = np.zeros((h + shadow_offset, w + shadow_offset, 4), dtype=np.uint8)
 
-    # Draw shadow if requested
-    if shadow:
-        shadow_color = (0, 0, 0, int(255 * shadow_opacity))
-        draw.text((x + shadow_offset, y + shadow_offset), text, font=font, fill=shadow_color)
+    # Shadow: the image's alpha mask, scaled by shadow_opacity, in black
+    scale = _alpha_scale(shadow_opacity)
+    canvas[shadow_offset:, shadow_offset:, 3] = (src[..., 3].astype(np.uint16) * scale >> 8).astype(np.uint8)
 
-    # Draw main text
-    r, g, b = text_color
-    fill = (r, g, b, int(255 * text_opacity))
-    draw.text((x, y), text, font=font, fill=fill)
+    # Composite the original over the shadow at the top-left corner. The
+    # shadow is black, so it only contributes to the resulting alpha.
+    src_a = src[..., 3].astype(np.uint32)
+    dst_a = canvas[:h, :w, 3].astype(np.uint32)
+    out_a = src_a * 255 + dst_a * (255 - src_a)
+    rgb = src[..., :3] * (src_a * 255)[..., None] // np.maximum(out_a, 1)[..., None]
+    canvas[:h, :w, :3] = rgb.astype(np.uint8)
+    canvas[:h, :w, 3] = (out_a // 255).astype(np.uint8)
 
-    return canvas
+    return Image.fromarray(canvas)
 
 
 def add_watermark(
     input_pdf: str,
-    output_pdf: str,
+    output_pdf: "str | io.BytesIO",
     watermark_image: str = None,
     watermark_text: str = None,
     image_opacity: float = 0.3,
@@ -86,69 +116,127 @@ def add_watermark(
     keywords: str = None,
     creator: str = None,
     producer: str = None,
+    # save options
+    compress: bool = False,
+    incremental: bool = False,
 ):
+    if incremental:
+        if compress:
+            raise ValueError("compress and incremental cannot be combined.")
+        if not (
+            isinstance(output_pdf, (str, os.PathLike))
+            and os.path.abspath(output_pdf) == os.path.abspath(input_pdf)
+        ):
+            raise ValueError("Incremental save requires output_pdf to be the same file as input_pdf.")
+
     # Open the input PDF
     doc = fitz.open(input_pdf)
 
-    # Compute maximum watermark size (90% of smallest page dimension)
-    max_width = min(page.rect.width for page in doc) * 0.9
-    max_height = min(page.rect.height for page in doc) * 0.9
-
     if watermark_text:
         # --- TEXT WATERMARK MODE ---
-        rgb = hex_to_rgb(text_color)
-        img = create_text_image(
-            watermark_text,
-            max_width,
-            max_height,
-            font_path,
-            font_size,
-            rgb,
-            text_opacity,
-            shadow,
-            shadow_opacity,
-        )
+        # Written as native PDF text operators rather than a rasterized
+        # image, so the output stays small and the watermark stays vector
+        fontname, fontfile = _resolve_font(font_path, watermark_text)
+        font = _load_font(fontname, fontfile)
+        text_w = font.text_length(watermark_text, fontsize=font_size)
+        text_h = (font.ascender - font.descender) * font_size
+        r, g, b = hex_to_rgb(text_color)
+        color = (r / 255, g / 255, b / 255)
+        # Skip the shadow when its opacity rounds to fully transparent
+        draw_shadow = shadow and _shadow_visible(shadow_opacity)
+        shadow_offset = 5
+
+        for page in doc:
+            rect = page.rect
+            x = (rect.width - text_w) / 2
+            # Baseline that vertically centers the ascender-descender box
+            y = (rect.height + text_h) / 2 + font.descender * font_size
+            if draw_shadow:
+                page.insert_text(
+                    (x + shadow_offset, y + shadow_offset),
+                    watermark_text,
+                    fontsize=font_size,
+                    fontname=fontname,
+                    fontfile=fontfile,
+                    color=(0, 0, 0),
+                    fill_opacity=shadow_opacity,
+                    overlay=True,
+                )
+            page.insert_text(
+                (x, y),
+                watermark_text,
+                fontsize=font_size,
+                fontname=fontname,
+                fontfile=fontfile,
+                color=color,
+                fill_opacity=text_opacity,
+                overlay=True,
+            )
     else:
         # --- IMAGE WATERMARK MODE ---
+        # Compute maximum watermark size (90% of smallest page dimension),
+        # loading each page only once for both dimensions
+        min_width = min_height = float("inf")
+        for page in doc:
+            rect = page.rect
+            min_width = min(min_width, rect.width)
+            min_height = min(min_height, rect.height)
+        max_width = min_width * 0.9
+        max_height = min_height * 0.9
+
         # Open and convert image
         img = Image.open(watermark_image).convert("RGBA")
 
         # Resize image to fit
         img.thumbnail((max_width, max_height))
 
-        # Adjust image opacity
+        # Adjust image opacity: scale the alpha channel in place through a
+        # 256-entry lookup table instead of split/enhance/merge
         if image_opacity < 1.0:
-            alpha = img.split()[3]
-            alpha = ImageEnhance.Brightness(alpha).enhance(image_opacity)
-            img.putalpha(alpha)
-
-        # Apply shadow under the image if desired
-        if shadow:
-            shadow_offset = 5
-            shadow_layer = Image.new(
-                "RGBA",
-                (img.width + shadow_offset, img.height + shadow_offset),
-                (0, 0, 0, int(255 * shadow_opacity)),
-            )
-            shadow_layer.paste(img, (shadow_offset, shadow_offset), img)
-            img = shadow_layer
+            buf = np.array(img)
+            scale = _alpha_scale(image_opacity)
+            lut = (np.arange(256, dtype=np.uint16) * scale >> 8).astype(np.uint8)
+            buf[..., 3] = lut[buf[..., 3]]
+            img = Image.fromarray(buf)
 
-    # Convert final watermark (PIL image) to a PNG byte stream
-    img_byte_arr = io.BytesIO()
-    img.save(img_byte_arr, format="PNG")
-    watermark_bytes = img_byte_arr.getvalue()
+        # Apply shadow under the image if desired and actually visible
+        if shadow and _shadow_visible(shadow_opacity):
+            img = add_image_shadow(img, shadow_opacity)
 
-    # Stamp each page
-    for page in doc:
-        rect = page.rect
+        # Hand the raw samples to PyMuPDF as a Pixmap, skipping the PNG
+        # encode here and the matching decode inside MuPDF. MuPDF expects
+        # premultiplied alpha, hence the RGBa conversion. Grayscale
+        # watermarks (including black shadows) go in as gray + alpha, half
+        # the bytes of RGBA; premultiplying zeroes the color of fully
+        # transparent pixels, so they never block the gray path.
+        buf = np.asarray(img.convert("RGBa"))
+        if ((buf[..., 0] == buf[..., 1]) & (buf[..., 1] == buf[..., 2])).all():
+            samples = np.ascontiguousarray(buf[..., ::3]).tobytes()
+            pixmap = fitz.Pixmap(fitz.csGRAY, img.width, img.height, samples, True)
+        else:
+            pixmap = fitz.Pixmap(fitz.csRGB, img.width, img.height, buf.tobytes(), True)
+
+        # Stamp each page. The image is embedded once on the first page; later
+        # pages reference the same XObject by xref instead of re-inserting it.
+        # Target rects are cached per page size, so uniform documents build
+        # a single Rect.
         w, h = img.size
-        x = (rect.width - w) / 2
-        y = (rect.height - h) / 2
-        page.insert_image(
-            fitz.Rect(x, y, x + w, y + h),
-            stream=watermark_bytes,
-            overlay=True,
-        )
+        rect_cache = {}
+        xref = 0
+        for page in doc:
+            rect = page.rect
+            key = (rect.width, rect.height)
+            target = rect_cache.get(key)
+            if target is None:
+                x = (rect.width - w) / 2
+                y = (rect.height - h) / 2
+                target = rect_cache[key] = fitz.Rect(x, y, x + w, y + h)
+            xref = page.insert_image(
+                target,
+                pixmap=pixmap if xref == 0 else None,
+                xref=xref,
+                overlay=True,
+            )
 
     # ——— UPDATE PDF METADATA ———
     meta = doc.metadata  # dict with keys: title, author, subject, keywords, creator, producer, etc.
@@ -167,10 +255,19 @@ def add_watermark(
 
     doc.set_metadata(meta)
 
-    # Save out
-    doc.save(output_pdf)
+    # Save out, either to a path or straight into a caller-supplied binary
+    # stream (e.g. io.BytesIO) without a temporary file. An incremental save
+    # appends only the new objects (watermark, metadata) to the input file;
+    # compress spends extra time on garbage collection and deflate to get a
+    # smaller file. The default rewrites every object as-is.
+    if incremental:
+        # MuPDF requires the exact name the document was opened with
+        doc.save(doc.name, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+    else:
+        doc.save(output_pdf, garbage=3 if compress else 0, deflate=compress)
     doc.close()
-    print(f"Watermark added successfully: {output_pdf}")
+    if isinstance(output_pdf, (str, os.PathLike)):
+        print(f"Watermark added successfully: {output_pdf}")
 
 
 if __name__ == "__main__":
@@ -198,7 +295,7 @@ if __name__ == "__main__":
     # Text watermark options
     parser.add_argument(
         "--font_path",
-        help="Path to a .ttf font file for text watermark (defaults to PIL's built-in font).",
+        help="Path to a .ttf font file for text watermark (defaults to Helvetica-Bold).",
     )
     parser.add_argument(
         "--font_size",
@@ -241,6 +338,21 @@ if __name__ == "__main__":
     parser.add_argument("--creator",  help="PDF creator metadata.")
     parser.add_argument("--producer", help="PDF producer metadata.")
 
+    # ——— Save options ———
+    save_group = parser.add_mutually_exclusive_group()
+    save_group.add_argument(
+        "--compress",
+        action="store_true",
+        default=False,
+        help="Remove unused objects and deflate streams (smaller output, slower save).",
+    )
+    save_group.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="Append changes to the input file in place (output_pdf must equal input_pdf).",
+    )
+
     args = parser.parse_args()
 
     add_watermark(
@@ -261,4 +373,6 @@ if __name__ == "__main__":
         keywords=args.keywords,
         creator=args.creator,
         producer=args.producer,
+        compress=args.compress,
+        incremental=args.incremental,
     )